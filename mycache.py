@@ -2,6 +2,8 @@ import time
 import random
 import os
 
+import numpy as np
+
 # How this simulator works
 # 1. parse trace file
 # 2. for each instruction, execute it
@@ -117,12 +119,12 @@ class Cache:
         return self.data[set_index][way]
     
     # calculate idle energy cost
-    def idle(self, time):
-        self.energy_consumption += self.idle_power * time
+    def idle(self, time, count=1):
+        self.energy_consumption += self.idle_power * time * count
     
     # calculate access (read/write) energy cost
-    def touch(self):
-        self.energy_consumption += self.read_write_power * L1_ACCESS_TIME
+    def touch(self, count=1):
+        self.energy_consumption += self.read_write_power * L1_ACCESS_TIME * count
         
     def transfer(self):
         self.energy_consumption += self.transfer_energy
@@ -234,6 +236,72 @@ class Cache:
         
         return False
 
+    # runs a whole chunk of accesses through a direct-mapped cache at once -> hit, dirty write back
+    # an access hits exactly when the previous access to its set left the same tag there,
+    # so sort by set and compare each tag with the one before it.
+    # does NOT go to the next cache, the caller replays the misses in trace order
+    def access_chunk(self, addresses, writes):
+        assert(self.assoc == 1)
+        
+        n = len(addresses)
+        hits = np.zeros(n, dtype=bool)
+        write_backs = np.zeros(n, dtype=bool)
+        if (n == 0):
+            return hits, write_backs
+        
+        set_index = (addresses >> self.n_s_bits) & ((1 << self.n_s_bits) - 1)
+        tag = addresses >> (int(log2(self.line_size)) + int(log2(self.num_sets)))
+        
+        # what is in each set before this chunk (left over from the last chunk)
+        lines = [ways[0] for ways in self.data]
+        start_valid = np.array([line.isValid() for line in lines], dtype=bool)
+        start_tag = np.array([line.tag for line in lines], dtype=np.int64)
+        start_dirty = np.array([line.isDirty() for line in lines], dtype=bool)
+        
+        # group by set, keeping trace order inside each set
+        order = np.argsort(set_index, kind="stable")
+        s = set_index[order]
+        t = tag[order]
+        w = writes[order]
+        
+        first = np.ones(n, dtype=bool) # first access to its set in this chunk
+        first[1:] = s[1:] != s[:-1]
+        last = np.ones(n, dtype=bool) # last access to its set in this chunk
+        last[:-1] = first[1:]
+        
+        hit = np.zeros(n, dtype=bool)
+        hit[1:] = t[1:] == t[:-1]
+        hit[first] = start_valid[s[first]] & (start_tag[s[first]] == t[first])
+        miss = ~hit
+        
+        # a residency is one miss (or the line we started with) plus the hits after it.
+        # the line is dirty at the end of a residency if a write hit it, put() on a miss clears dirty
+        residency = np.cumsum(miss | first) - 1
+        dirty = np.bincount(residency, weights=w & hit, minlength=residency[-1] + 1) > 0
+        carried = first & hit
+        dirty[residency[carried]] |= start_dirty[s[carried]]
+        
+        # a miss writes back if the line it replaces was dirty
+        write_back = np.zeros(n, dtype=bool)
+        write_back[first & miss] = start_dirty[s[first & miss]]
+        replaced = miss & ~first
+        write_back[replaced] = dirty[residency[replaced] - 1]
+        
+        # leave the cache as the last access to each set left it
+        for set_i, tag_i, dirty_i in zip(s[last].tolist(), t[last].tolist(), dirty[residency[last]].tolist()):
+            line = self.data[set_i][0]
+            line.put(tag_i, "data")
+            line.dirty = dirty_i
+        
+        hits[order] = hit
+        write_backs[order] = write_back
+        
+        self.hits += int(hit.sum())
+        self.misses += int(miss.sum())
+        self.evicitions += int(write_back.sum())
+        
+        return hits, write_backs
+
 # DRAM simulation
 class DRAM:
     def __init__(self, size, access_time, idle_power, read_write_power):
@@ -255,8 +323,8 @@ class DRAM:
         self.hits += 1
         return True, False
     
-    def idle(self, time):
-        self.energy_consumption += self.idle_power * time
+    def idle(self, time, count=1):
+        self.energy_consumption += self.idle_power * time * count
     
     def touch(self):
         self.energy_consumption += self.read_write_power * self.access_time
@@ -297,6 +365,8 @@ DRAM_TRANSFER_ENERGY = 640  # 640 pJ
 
 CPU_CLOCK_SPEED = 2  # 2 GHz
 
+TRACE_CHUNK_SIZE = 100000  # accesses handed to execute_chunk at a time
+
 class SIM:
     def __init__(self, l2_assoc):
         L2_ASSOC = l2_assoc
@@ -421,12 +491,55 @@ class SIM:
             
         pass
     
+    # same as execute + step_other for every access in the chunk, but the L1s are done in bulk
+    # with access_chunk and only the L1 misses go through the L2 one at a time
+    def execute_chunk(self, addresses, ops):
+        assert(not (ops == 4).any())
+        
+        n = len(ops)
+        l1_hits = np.zeros(n, dtype=bool)
+        l1_write_backs = np.zeros(n, dtype=bool)
+        
+        instr = ops == 2
+        data = (ops == 0) | (ops == 1)
+        l1_hits[instr], l1_write_backs[instr] = self.instr_l1.access_chunk(addresses[instr], ops[instr] == 1)
+        l1_hits[data], l1_write_backs[data] = self.data_l1.access_chunk(addresses[data], ops[data] == 1)
+        
+        # an L1 hit costs the same every time, add them all up at once
+        instr_hits = int((instr & l1_hits).sum())
+        data_hits = int((data & l1_hits).sum())
+        self.total_accesses += instr_hits + data_hits # instruction fetch hits take no time
+        
+        self.time += L1_ACCESS_TIME * data_hits
+        self.data_l1.touch(data_hits)
+        self.instr_l1.idle(L1_ACCESS_TIME, data_hits)
+        self.l2.idle(L1_ACCESS_TIME, data_hits)
+        self.dram.idle(L1_ACCESS_TIME, data_hits)
+        
+        # everything else goes through the L2 in trace order
+        rest = np.flatnonzero(~l1_hits)
+        for address, op, write_back in zip(addresses[rest].tolist(), ops[rest].tolist(), l1_write_backs[rest].tolist()):
+            if (op == 3):
+                self.account(op, False, False, False, False, False)
+                continue
+            
+            l2_evictions = self.l2.evicitions
+            if (write_back):
+                self.l2.evict(address)
+            l2_hit = self.l2.access(address, op)
+            self.account(op, False, l2_hit, not l2_hit, write_back, self.l2.evicitions > l2_evictions)
+        
+        self.update_stats()
+    
     # ED: "copy of data DRAM -> L2 and L2 -> L1 on misses do not take extra time or extra active energy for the writes - this is included in penalty energy."
     
     def step_other(self, op):
                 # for each action, check current state with previous stats to see what happened
         l1_hit, l2_hit, missed, l1_evicted, l2_evicted = self.update_stats()
-        
+        self.account(op, l1_hit, l2_hit, missed, l1_evicted, l2_evicted)
+
+    # time and energy for one access, given where it was served from and what it evicted
+    def account(self, op, l1_hit, l2_hit, missed, l1_evicted, l2_evicted):
         time_passed = 0
         
         assert(not (l1_hit and l2_hit))
@@ -648,13 +761,11 @@ def run_trace(trace, L2_ASSOC):
     parsed_data = parse_trace_file(file_path)
 
     print(f"\n\nRunning trace: {trace}")
-    for op, address, value in parsed_data:
-        # print(f"OP: {op}, Address: {address}, Value: {value}")
-        assert(op != 4)
-        simulator.execute(address, op, value)
-        simulator.step_other(op)
-
-        # break
+    ops = np.array([op for op, _, _ in parsed_data], dtype=np.int64)
+    addresses = np.array([address for _, address, _ in parsed_data], dtype=np.int64)
+    for start in range(0, len(ops), TRACE_CHUNK_SIZE):
+        end = start + TRACE_CHUNK_SIZE
+        simulator.execute_chunk(addresses[start:end], ops[start:end])
         
     simulator.show_sim_data()
     